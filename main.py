@@ -1,14 +1,52 @@
+import asyncio
+import logging
 import os
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from typing import List, Literal, Optional
-
-from fastapi import FastAPI
+from types import MappingProxyType
+from typing import List, Mapping, NamedTuple, Optional
+
+import orjson
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+from fastapi import FastAPI, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 
-from database import create_document, get_documents, db
+from database import async_db, count_documents_async, create_documents_async
+from schemas import AgentStep, Finding
+
+try:
+    import ahocorasick
+except ImportError:
+    # Fall back to one str.find() scan per rule. A single alternation regex is not
+    # used: finditer() never reports two rules whose matches overlap.
+    ahocorasick = None
+
+logger = logging.getLogger(__name__)
+
 
-app = FastAPI(title="AgentForge API", version="0.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the analysis write queue and indexes on boot; drain the queue on shutdown"""
+    app.state.write_q = asyncio.Queue(maxsize=WRITE_QUEUE_MAX)
+    app.state.flusher = asyncio.create_task(_flush_analyses(app.state.write_q))
+    # Index creation waits on Mongo, so it runs in the background instead of delaying boot
+    app.state.indexer = asyncio.create_task(ensure_indexes())
+    yield
+    app.state.indexer.cancel()
+    await _drain_write_queue(app.state.write_q, app.state.flusher)
+
+
+app = FastAPI(
+    title="AgentForge API",
+    version="0.1.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,22 +57,6 @@ app.add_middleware(
 )
 
 
-class Finding(BaseModel):
-    rule_id: str
-    title: str
-    severity: Literal["low", "medium", "high", "critical"]
-    line: Optional[int] = None
-    description: str
-    recommendation: str
-
-
-class AgentStep(BaseModel):
-    agent: str
-    action: str
-    output: str
-    elapsed_ms: int
-
-
 class AnalyzeRequest(BaseModel):
     code: str = Field(..., description="Source code snippet to analyze")
     language: str = Field("python", description="Programming language")
@@ -47,18 +69,23 @@ class AnalyzeResponse(BaseModel):
     analysis_id: str
 
 
+# Static payloads are serialized once at import instead of on every request
+_ROOT_JSON = orjson.dumps({"message": "AgentForge Backend Running"})
+_HELLO_JSON = orjson.dumps({"message": "Hello from the backend API!"})
+
+
 @app.get("/")
-def read_root():
-    return {"message": "AgentForge Backend Running"}
+async def read_root():
+    return Response(content=_ROOT_JSON, media_type="application/json")
 
 
 @app.get("/api/hello")
-def hello():
-    return {"message": "Hello from the backend API!"}
+async def hello():
+    return Response(content=_HELLO_JSON, media_type="application/json")
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     """Test endpoint to check if database is available and accessible"""
     response = {
         "backend": "✅ Running",
@@ -70,13 +97,13 @@ def test_database():
     }
 
     try:
-        if db is not None:
+        if async_db is not None:
             response["database"] = "✅ Available"
             response["database_url"] = "✅ Configured"
-            response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
+            response["database_name"] = async_db.name if hasattr(async_db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await async_db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -94,121 +121,365 @@ def test_database():
     return response
 
 
+class Rule(NamedTuple):
+    id: str
+    language: str
+    match: str
+    title: str
+    severity: str
+    description: str
+    recommendation: str
+    weight: int
+    # Static part of every Finding the rule produces; only "line" varies per hit
+    template: Mapping[str, Optional[str]]
+
+
+_SEV = {"low": 1, "medium": 2, "high": 3, "critical": 5}
+
+
+def _rule(**fields) -> Rule:
+    """Build a Rule, deriving its weight and Finding template from the given fields"""
+    return Rule(
+        **fields,
+        weight=_SEV[fields["severity"]],
+        template=MappingProxyType({
+            "rule_id": fields["id"],
+            "title": fields["title"],
+            "severity": fields["severity"],
+            "line": None,
+            "description": fields["description"],
+            "recommendation": fields["recommendation"],
+        }),
+    )
+
+
 # Simple heuristic-based analyzer to simulate agents collaborating
 SECURITY_RULES = [
-    {
-        "id": "AF-PY-001",
-        "language": "python",
-        "match": "eval(",
-        "title": "Use of eval()",
-        "severity": "high",
-        "description": "The built-in eval() executes arbitrary code and can be exploited.",
-        "recommendation": "Avoid eval(); use safe parsing or literal_eval for trusted input.",
-    },
-    {
-        "id": "AF-SQL-001",
-        "language": "any",
-        "match": "SELECT * FROM",
-        "title": "Potential SQL injection (raw query)",
-        "severity": "critical",
-        "description": "Raw SQL concatenation can lead to SQL injection.",
-        "recommendation": "Use parameterized queries or ORM query builders.",
-    },
-    {
-        "id": "AF-JS-001",
-        "language": "javascript",
-        "match": "innerHTML =",
-        "title": "Unsafe DOM insertion",
-        "severity": "high",
-        "description": "Assigning to innerHTML can enable XSS if input is untrusted.",
-        "recommendation": "Use textContent or sanitize HTML before insertion.",
-    },
+    _rule(
+        id="AF-PY-001",
+        language="python",
+        match="eval(",
+        title="Use of eval()",
+        severity="high",
+        description="The built-in eval() executes arbitrary code and can be exploited.",
+        recommendation="Avoid eval(); use safe parsing or literal_eval for trusted input.",
+    ),
+    _rule(
+        id="AF-SQL-001",
+        language="any",
+        match="SELECT * FROM",
+        title="Potential SQL injection (raw query)",
+        severity="critical",
+        description="Raw SQL concatenation can lead to SQL injection.",
+        recommendation="Use parameterized queries or ORM query builders.",
+    ),
+    _rule(
+        id="AF-JS-001",
+        language="javascript",
+        match="innerHTML =",
+        title="Unsafe DOM insertion",
+        severity="high",
+        description="Assigning to innerHTML can enable XSS if input is untrusted.",
+        recommendation="Use textContent or sanitize HTML before insertion.",
+    ),
 ]
 
 
-@app.post("/api/analyze", response_model=AnalyzeResponse)
-def analyze(req: AnalyzeRequest):
-    code_lines = req.code.splitlines()
-    findings: List[Finding] = []
-    steps: List[AgentStep] = []
+def _build_automaton(rules):
+    """Compile (index, rule) pairs into one Aho-Corasick automaton over rule.match"""
+    automaton = ahocorasick.Automaton()
+    for idx, rule in rules:
+        # Several rules may share a pattern, so each key maps to a tuple of rule indexes
+        automaton.add_word(rule.match, automaton.get(rule.match, ()) + (idx,))
+    automaton.make_automaton()
+    return automaton
+
+
+def _rules_for(lang):
+    return [(i, r) for i, r in enumerate(SECURITY_RULES) if r.language in ("any", lang)]
+
+
+# Rules applicable to each language, with the "any" rules merged in; "_any" covers
+# languages that have no dedicated rules
+_RULES_BY_LANG = {
+    lang: _rules_for(lang)
+    for lang in {r.language for r in SECURITY_RULES} - {"any"}
+}
+_RULES_BY_LANG["_any"] = _rules_for("any")
+
+# First character of every applicable pattern; code containing none of them cannot match
+_FIRST_CHARS = {lang: frozenset(r.match[0] for _, r in rules) for lang, rules in _RULES_BY_LANG.items()}
+
+# A pass over an automaton costs O(len(code) + hits) however many rules it holds
+_AUTOMATA = (
+    {lang: _build_automaton(rules) for lang, rules in _RULES_BY_LANG.items()}
+    if ahocorasick is not None
+    else {}
+)
+
+
+WRITE_BATCH_SIZE = 256
+WRITE_FLUSH_INTERVAL_S = 0.05
+# Bounded so a stalled database applies backpressure to analyze instead of growing memory
+WRITE_QUEUE_MAX = 10_000
+WRITE_MAX_ATTEMPTS = 5
+WRITE_RETRY_BASE_S = 0.5
+# Upper bound on how long shutdown waits for queued writes to land
+WRITE_DRAIN_TIMEOUT_S = 10
+DUPLICATE_KEY = 11000
+
+# Documents taken off the queue but not yet settled, for shutdown accounting
+_write_state = {"in_flight": 0}
+
+
+async def _persist_batch(batch: list):
+    """Insert batch, retrying failed documents with backoff; returns the ones given up on"""
+    pending = batch
+    for attempt in range(1, WRITE_MAX_ATTEMPTS + 1):
+        try:
+            await create_documents_async("analysis", pending)
+            return []
+        except BulkWriteError as e:
+            # ordered=False: every document not listed in writeErrors was written, and a
+            # duplicate key means an earlier attempt already stored that _id
+            failed = [err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY]
+            pending = [pending[i] for i in failed]
+            if not pending:
+                return []
+            logger.warning("Attempt %d: %d analyses failed to persist", attempt, len(pending))
+        except Exception:
+            logger.warning("Attempt %d: %d analyses failed to persist", attempt, len(pending), exc_info=True)
+        if attempt < WRITE_MAX_ATTEMPTS:
+            await asyncio.sleep(WRITE_RETRY_BASE_S * 2 ** (attempt - 1))
+    return pending
+
+
+async def _flush_analyses(q: asyncio.Queue):
+    """Drain queued analysis documents into Mongo with one insert_many per batch"""
+    while True:
+        batch = [await q.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        _write_state["in_flight"] = len(batch)
+        try:
+            lost = await _persist_batch(batch)
+            if lost:
+                logger.error("Dropped %d analyses after %d attempts", len(lost), WRITE_MAX_ATTEMPTS)
+        finally:
+            _write_state["in_flight"] = 0
+            for _ in batch:
+                q.task_done()
+        await asyncio.sleep(WRITE_FLUSH_INTERVAL_S)
+
+
+async def _drain_write_queue(q: asyncio.Queue, flusher: asyncio.Task):
+    """Give pending writes up to WRITE_DRAIN_TIMEOUT_S to land, then stop the flusher"""
+    try:
+        await asyncio.wait_for(q.join(), timeout=WRITE_DRAIN_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        logger.error(
+            "Dropping %d unpersisted analyses at shutdown",
+            q.qsize() + _write_state["in_flight"],
+        )
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+
+
+def _scan(code: str, language: str):
+    """Run the agent pipeline over code; returns (finding dicts, step dicts, score)"""
+    lang = language.lower()
+    step_dicts: List[dict] = []
 
     # Step 1: Static scan
-    steps.append(AgentStep(agent="StaticAnalyzer", action="Token scan", output="Scanning for insecure patterns", elapsed_ms=42))
-
-    for i, line in enumerate(code_lines, start=1):
-        for rule in SECURITY_RULES:
-            if rule["language"] in ("any", req.language.lower()) and rule["match"] in line:
-                findings.append(Finding(
-                    rule_id=rule["id"],
-                    title=rule["title"],
-                    severity=rule["severity"],
-                    line=i,
-                    description=rule["description"],
-                    recommendation=rule["recommendation"],
-                ))
+    step_dicts.append({"agent": "StaticAnalyzer", "action": "Token scan", "output": "Scanning for insecure patterns", "elapsed_ms": 42})
+
+    key = lang if lang in _RULES_BY_LANG else "_any"
+
+    # (offset, rule index) for every hit; pattern matches never span a newline
+    matches = []
+    # Prefilter: skip the scan when no applicable pattern can even start in code
+    if any(c in code for c in _FIRST_CHARS[key]):
+        if ahocorasick is not None:
+            for end, matched in _AUTOMATA[key].iter(code):
+                for idx in matched:
+                    matches.append((end, idx))
+        else:
+            for idx, rule in _RULES_BY_LANG[key]:
+                pat = rule.match
+                pos = code.find(pat)
+                while pos != -1:
+                    matches.append((pos, idx))
+                    # A rule is reported once per line, so resume on the next line
+                    eol = code.find("\n", pos)
+                    if eol == -1:
+                        break
+                    pos = code.find(pat, eol + 1)
+
+    # Resolve line numbers in one forward walk over the sorted hits, counting only the
+    # newlines between consecutive hits instead of indexing every newline in the source
+    hits = set()
+    line, prev = 1, 0
+    for off, idx in sorted(matches):
+        line += code.count("\n", prev, off)
+        prev = off
+        hits.add((line, idx))
+
+    # Report each rule at most once per line, ordered by line then rule table order
+    hit_rules = []
+    finding_dicts = []
+    for line, idx in sorted(hits):
+        rule = SECURITY_RULES[idx]
+        hit_rules.append(rule)
+        finding_dicts.append({**rule.template, "line": line})
 
     # Step 2: Heuristic risk scoring
-    sev_weights = {"low": 1, "medium": 2, "high": 3, "critical": 5}
-    raw_score = sum(sev_weights[f.severity] for f in findings) * 10
+    raw_score = sum(r.weight for r in hit_rules) * 10
     score = max(0, 100 - min(100, raw_score))
-    steps.append(AgentStep(agent="RiskScorer", action="Compute score", output=f"Score={score}", elapsed_ms=15))
+    step_dicts.append({"agent": "RiskScorer", "action": "Compute score", "output": f"Score={score}", "elapsed_ms": 15})
 
     # Step 3: Remediation agent suggestion
-    if findings:
-        steps.append(AgentStep(agent="Remediator", action="Suggest fixes", output=f"{len(findings)} suggestions ready", elapsed_ms=18))
+    if finding_dicts:
+        step_dicts.append({"agent": "Remediator", "action": "Suggest fixes", "output": f"{len(finding_dicts)} suggestions ready", "elapsed_ms": 18})
     else:
-        steps.append(AgentStep(agent="Remediator", action="No issues", output="Clean bill of health", elapsed_ms=8))
+        step_dicts.append({"agent": "Remediator", "action": "No issues", "output": "Clean bill of health", "elapsed_ms": 8})
+
+    return finding_dicts, step_dicts, score
+
+
+# Below this many characters the scan is cheaper than a threadpool hand-off
+SCAN_INLINE_MAX_CHARS = 4096
+
+
+# Whitespace-only input has nothing to scan or persist, so it gets a fixed clean
+# result with no analysis_id
+_empty_findings, _empty_steps, _empty_score = _scan("", "any")
+_EMPTY_ANALYSIS_RESPONSE = AnalyzeResponse(
+    score=_empty_score,
+    findings=[Finding(**d) for d in _empty_findings],
+    steps=[AgentStep(**d) for d in _empty_steps],
+    analysis_id="",
+)
 
-    # Persist analysis
+
+@app.post("/api/analyze", response_model=AnalyzeResponse)
+async def analyze(req: AnalyzeRequest):
+    if not req.code.strip():
+        return _EMPTY_ANALYSIS_RESPONSE
+
+    if len(req.code) < SCAN_INLINE_MAX_CHARS:
+        finding_dicts, step_dicts, score = _scan(req.code, req.language)
+    else:
+        # Keep the event loop free while large inputs are scanned
+        finding_dicts, step_dicts, score = await run_in_threadpool(_scan, req.code, req.language)
+
+    # Persist analysis: the write is queued and batched by _flush_analyses, so the
+    # id is generated up front and returned before the insert lands
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    _id = ObjectId()
     doc = {
+        "_id": _id,
         "code": req.code,
         "language": req.language,
-        "findings": [f.model_dump() for f in findings],
-        "steps": [s.model_dump() for s in steps],
+        "findings": finding_dicts,
+        "steps": step_dicts,
         "score": score,
         "created_at": datetime.now(timezone.utc),
     }
-    analysis_id = create_document("analysis", doc)
-
-    return AnalyzeResponse(score=score, findings=findings, steps=steps, analysis_id=analysis_id)
+    await app.state.write_q.put(doc)
+    analysis_id = str(_id)
+
+    # Findings and steps are built from trusted dicts, so the models skip validation
+    return AnalyzeResponse.model_construct(
+        score=score,
+        findings=[Finding.model_construct(**d) for d in finding_dicts],
+        steps=[AgentStep.model_construct(**d) for d in step_dicts],
+        analysis_id=analysis_id,
+    )
+
+
+ISSUES_FIXED_TTL_S = 30
+_issues_fixed_cache = {"exp": 0.0, "val": 1247}
+_MIDNIGHT_CACHE = [None, None]
+CREATED_AT_INDEX = "created_at_1"
+INDEX_RETRY_S = 30
+# Only hint the index once it is known to exist; Mongo rejects hints for missing indexes
+_created_at_indexed = False
+
+
+def _utc_midnight():
+    """Start of the current UTC day, rebuilt only when the date rolls over"""
+    today = datetime.now(timezone.utc).date()
+    if _MIDNIGHT_CACHE[0] != today:
+        _MIDNIGHT_CACHE[:] = [today, datetime(today.year, today.month, today.day, tzinfo=timezone.utc)]
+    return _MIDNIGHT_CACHE[1]
+
+
+async def ensure_indexes():
+    """Create the created_at index, retrying until Mongo accepts it"""
+    global _created_at_indexed
+    if async_db is None:
+        return
+    while True:
+        try:
+            await async_db.analysis.create_index("created_at", name=CREATED_AT_INDEX)
+            _created_at_indexed = True
+            return
+        except Exception:
+            logger.warning("Could not create index %s; retrying in %ds", CREATED_AT_INDEX, INDEX_RETRY_S, exc_info=True)
+            await asyncio.sleep(INDEX_RETRY_S)
 
 
 @app.get("/api/metrics/issues-fixed-today")
-def issues_fixed_today():
+async def issues_fixed_today():
+    now = time.monotonic()
+    if now < _issues_fixed_cache["exp"]:
+        return {"count": _issues_fixed_cache["val"]}
     try:
-        start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
-        docs = get_documents("analysis", {"created_at": {"$gte": start}})
+        start = _utc_midnight()
+        total = await count_documents_async(
+            "analysis",
+            {"created_at": {"$gte": start}},
+            hint=CREATED_AT_INDEX if _created_at_indexed else None,
+        )
         # Fake conversion: assume half had fixes applied
-        count = max(1247, int(len(docs) * 0.5) + 1247)
-        return {"count": count}
+        count = max(1247, int(total * 0.5) + 1247)
     except Exception:
         return {"count": 1247}
+    _issues_fixed_cache.update(exp=now + ISSUES_FIXED_TTL_S, val=count)
+    return {"count": count}
+
+
+_SOCIAL_PROOF_JSON = orjson.dumps({
+    "stars": 8231,
+    "logos": [
+        "Google",
+        "Meta",
+        "Stripe",
+        "Shopify",
+        "Datadog",
+    ],
+    "testimonials": [
+        {
+            "name": "Priya S.",
+            "title": "Staff Engineer, Fintech",
+            "quote": "AgentForge caught a critical SQLi our SAST missed.",
+        },
+        {
+            "name": "Dan M.",
+            "title": "Eng Manager, SaaS",
+            "quote": "Felt like pairing with a senior security engineer.",
+        },
+    ],
+})
 
 
 @app.get("/api/social-proof")
-def social_proof():
-    return {
-        "stars": 8231,
-        "logos": [
-            "Google",
-            "Meta",
-            "Stripe",
-            "Shopify",
-            "Datadog",
-        ],
-        "testimonials": [
-            {
-                "name": "Priya S.",
-                "title": "Staff Engineer, Fintech",
-                "quote": "AgentForge caught a critical SQLi our SAST missed.",
-            },
-            {
-                "name": "Dan M.",
-                "title": "Eng Manager, SaaS",
-                "quote": "Felt like pairing with a senior security engineer.",
-            },
-        ],
-    }
+async def social_proof():
+    return Response(content=_SOCIAL_PROOF_JSON, media_type="application/json")
 
 
 if __name__ == "__main__":